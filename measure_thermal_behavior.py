@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 from datetime import timedelta, datetime
 from os import error
+from os.path import splitext
 from time import sleep
-from requests import get, post
+import requests
+from requests.adapters import HTTPAdapter
 import re
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 ######### META DATA #################
 # For data collection organizational purposes
@@ -56,9 +66,14 @@ start_time = datetime.now() + timedelta(days=1)
 index = 0
 BASE_URL = BASE_URL.strip('/')  # remove any errant "/" from the address
 
+# Reuse one keep-alive connection to Moonraker for all requests
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+GCODE_URL = BASE_URL + '/printer/gcode/script'
+
 
 def gather_metadata():
-    resp = get(BASE_URL + '/printer/objects/query?configfile').json()
+    resp = SESSION.get(BASE_URL + '/printer/objects/query?configfile').json()
     config = resp['result']['status']['configfile']['settings']
 
     # Gather Z axis information
@@ -124,7 +139,7 @@ def write_metadata(meta):
         dataout.write('### METADATA END ###\n')
 
 def query_axis_bounds(axis):
-    resp = get(BASE_URL + '/printer/objects/query?configfile').json()
+    resp = SESSION.get(BASE_URL + '/printer/objects/query?configfile').json()
     config = resp['result']['status']['configfile']['settings']
 
     stepper = 'stepper_%s' % axis
@@ -135,7 +150,7 @@ def query_axis_bounds(axis):
     return(axis_min, axis_max) 
 
 def query_xy_middle():
-    resp = get(BASE_URL + '/printer/objects/query?configfile').json()
+    resp = SESSION.get(BASE_URL + '/printer/objects/query?configfile').json()
     config = resp['result']['status']['configfile']['settings']
 
     x_min = config['stepper_x']['position_min']
@@ -150,24 +165,21 @@ def query_xy_middle():
 
 
 def send_gcode_nowait(cmd=''):
-    url = BASE_URL + "/printer/gcode/script?script=%s" % cmd
-    post(url)
+    SESSION.post(GCODE_URL, params={'script': cmd})
     return True
 
 
 def send_gcode(cmd='', retries=1):
-    url = BASE_URL + "/printer/gcode/script?script=%s" % cmd
-    resp = post(url)
-    success = None
     for i in range(retries):
-        try:
-            success = 'ok' in resp.json()['result']
-        except KeyError:
-            print("G-code command '%s', failed. Retry %i/%i" % (cmd,
-                                                                i+1,
-                                                                retries))
-        else:
+        resp = SESSION.post(GCODE_URL, params={'script': cmd})
+        # Moonraker replies with 'result' on success and 'error' otherwise
+        if 'result' in resp.json():
             return True
+        print("G-code command '%s', failed. Retry %i/%i" % (cmd,
+                                                            i+1,
+                                                            retries))
+        if i + 1 < retries:
+            sleep(0.5)
     return False
 
 
@@ -210,7 +222,7 @@ def set_hetemp(t=0):
 
 def gantry_leveled():
     url = BASE_URL + '/printer/objects/query?quad_gantry_level'
-    resp = get(url).json()['result']
+    resp = SESSION.get(url).json()['result']
     return resp['status']['quad_gantry_level']['applied']
 
 
@@ -260,14 +272,18 @@ def query_bed_mesh(retries=60):
     mesh_received = False
     for attempt in range(retries):
         print('.', end='', flush=True)
-        resp = get(url).json()['result']
+        resp = SESSION.get(url).json()['result']
         mesh = resp['status']['bed_mesh']
         if mesh['mesh_matrix'] != [[]]:
             mesh_received = True
+            if np is not None:
+                mesh['probed_matrix'] = np.asarray(mesh['probed_matrix'],
+                                                   dtype=np.float64)
             print('DONE!', flush=True)
             return mesh
         else:
-            sleep(10)
+            # back off exponentially, polling at most every 10s
+            sleep(min(10, 2**attempt))
     if not mesh_received:
         raise RuntimeError("Could not retrieve mesh")
 
@@ -284,7 +300,7 @@ def query_temp_sensors():
     base_t_str = 'extruder&heater_bed'
     url = BASE_URL + '/printer/objects/query?{0}{1}'.format(base_t_str,
                                                             extra_t_str)
-    resp = get(url).json()['result']['status']
+    resp = SESSION.get(url).json()['result']['status']
     try:
         chamber_current = resp[CHAMBER_SENSOR]['temperature']
     except KeyError:
@@ -317,7 +333,7 @@ def query_temp_sensors():
 
 def get_cached_gcode(n=1):
     url = BASE_URL + "/server/gcode_store?count=%i" % n
-    resp = get(url).json()['result']['gcode_store']
+    resp = SESSION.get(url).json()['result']['gcode_store']
     return resp
 
 
@@ -339,6 +355,7 @@ def wait_for_bedtemp(soak_time=5):
             print("Reached temp, heat soaking bed...")
             sleep(soak_time*60)
             break
+        sleep(2)
     print('\nBed temp reached')
 
 
@@ -390,6 +407,47 @@ def measure():
         print('Next measurement in %02is' % t_minus, end='\r', flush=True)
 
 
+def json_default(obj):
+    # Probed matrices are kept as ndarrays when numpy is available
+    if np is not None and isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def write_results(output):
+    if orjson is not None:
+        # Pass datetimes through to json_default so timestamps are written
+        # in the same format as the json fallback.
+        opts = (orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS |
+                orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME)
+        with open(DATA_FILENAME, "wb") as out_file:
+            out_file.write(orjson.dumps(output, default=json_default,
+                                        option=opts))
+    else:
+        with open(DATA_FILENAME, "w") as out_file:
+            json.dump(output, out_file, indent=4, sort_keys=True,
+                      default=json_default)
+
+
+def write_results_npz(output):
+    # Binary copy of the results for process_meshes.py: probed matrices are
+    # stored as float arrays, everything else as a JSON string under 'meta'.
+    if np is None:
+        return
+    meta = {}
+    meshes = {}
+    for section, data in output.items():
+        if section.endswith('_mesh'):
+            mesh = dict(data['mesh'])
+            meshes[section] = np.asarray(mesh.pop('probed_matrix'),
+                                         dtype=np.float64)
+            data = {**data, 'mesh': mesh}
+        meta[section] = data
+    np.savez_compressed(splitext(DATA_FILENAME)[0] + '.npz',
+                        meta=json.dumps(meta, default=json_default),
+                        **meshes)
+
+
 def main():
     global last_measurement, start_time, temps
     metadata = gather_metadata()
@@ -483,12 +541,18 @@ def main():
               'hot_mesh': hot_data,
               'temp_data': temps}
 
-    with open(DATA_FILENAME, "w") as out_file:
-        json.dump(output, out_file, indent=4, sort_keys=True, default=str)
+    write_results(output)
 
     set_bedtemp()
     set_hetemp()
     send_gcode('SET_FRAME_COMP enable=1')
+
+    # The npz copy is only a convenience for plotting; the json above is
+    # the record, so don't let a failure here abort the run.
+    try:
+        write_results_npz(output)
+    except (OSError, TypeError, ValueError) as e:
+        print('Could not write npz copy of results: %s' % e)
     print('Measurements complete!')
 
 
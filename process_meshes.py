@@ -1,17 +1,36 @@
 import json
+import re
 import sys
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import numpy as np
 import matplotlib
-from matplotlib import cm
+# Plots are only written to disk, so use the non-interactive backend.
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from matplotlib.colors import TwoSlopeNorm
+from multiprocessing import Pool, cpu_count
 from os.path import splitext, join
 
 
+# Plain "{x:.2f}"-style formats that have an exact printf equivalent.
+SIMPLE_VALFMT_RE = re.compile(r'^\{x:([+ #0]?\d*(?:\.\d+)?[eEfFgG])\}$')
+
+# Fixed figure margins, used instead of tight_layout so that no extra
+# layout pass is needed per figure.
+MESH_MARGINS = dict(left=0.1, right=0.95, top=0.82, bottom=0.05)
+PROFILE_MARGINS = dict(left=0.1, right=0.95, top=0.8, bottom=0.08,
+                       hspace=0.45)
+
+# Shared color scale for all mesh heatmaps, in mm of Z offset.
+MESH_NORM = TwoSlopeNorm(vmin=-0.2, vcenter=0, vmax=0.2)
+
+
 def import_mesh(mesh):
-    if all([x in mesh.keys() for x in ['mesh_min',
-                                       'mesh_max',
-                                       'probed_matrix']]):
+    if mesh.keys() >= {'mesh_min', 'mesh_max', 'probed_matrix'}:
         mesh_min = mesh['mesh_min']
         mesh_max = mesh['mesh_max']
         probed_matrix = mesh['probed_matrix']
@@ -19,17 +38,15 @@ def import_mesh(mesh):
         n_y_points = len(probed_matrix)
         n_x_points = len(probed_matrix[0])
 
-        x_coords = np.round(np.linspace(mesh_min[0],
-                                        mesh_max[0],
-                                        n_x_points,
-                                        float),
-                            decimals=1)
-        y_coords = np.round(np.linspace(mesh_min[1],
-                                        mesh_max[1],
-                                        n_y_points,
-                                        float),
-                            decimals=1)
-        mesh_points = np.array(probed_matrix, float)
+        x_coords = np.linspace(mesh_min[0],
+                               mesh_max[0],
+                               n_x_points,
+                               dtype=np.float64)
+        y_coords = np.linspace(mesh_min[1],
+                               mesh_max[1],
+                               n_y_points,
+                               dtype=np.float64)
+        mesh_points = np.asarray(probed_matrix, dtype=np.float64)
 
         return {'x': x_coords, 'y': y_coords, 'mesh': mesh_points}
 
@@ -58,7 +75,7 @@ def heatmap(data, row_labels, col_labels, ax=None,
         All other arguments are forwarded to `imshow`.
     """
 
-    if not ax:
+    if ax is None:
         ax = plt.gca()
 
     # Plot the heatmap
@@ -80,12 +97,13 @@ def heatmap(data, row_labels, col_labels, ax=None,
                    labeltop=True, labelbottom=False)
 
     # Rotate the tick labels and set their alignment.
-    plt.setp(ax.get_xticklabels(), rotation=-30, ha="right",
-             rotation_mode="anchor")
+    for label in ax.get_xticklabels():
+        label.set_rotation(-30)
+        label.set_horizontalalignment("right")
+        label.set_rotation_mode("anchor")
 
     # Turn spines off and create white grid.
-    for edge, spine in ax.spines.items():
-        spine.set_visible(False)
+    ax.set_frame_on(False)
 
     ax.set_xticks(np.arange(data.shape[1]+1)-.5, minor=True)
     ax.set_yticks(np.arange(data.shape[0]+1)-.5, minor=True)
@@ -138,36 +156,62 @@ def annotate_heatmap(im, data=None, valfmt="{x:.2f}",
               verticalalignment="center")
     kw.update(textkw)
 
-    # Get the formatter in case a string is supplied
+    # Normalize the whole array once and pre-format every label, so the
+    # loop below only has to place the `Text` artists.
+    normed = np.asarray(im.norm(data))
+    color_idx = (normed > threshold).astype(int)
+
+    simple_fmt = None
     if isinstance(valfmt, str):
+        simple_fmt = SIMPLE_VALFMT_RE.match(valfmt)
+        # Get the formatter in case a string is supplied
         valfmt = matplotlib.ticker.StrMethodFormatter(valfmt)
 
+    values = np.ma.getdata(data)
+    if simple_fmt:
+        # Skip the generic Formatter dispatch for plain numeric formats
+        # and format the whole array in one call.
+        strings = np.char.mod('%' + simple_fmt.group(1),
+                              values).astype(object)
+    else:
+        strings = np.vectorize(lambda v: valfmt(v, None),
+                               otypes=[object])(values)
+
+    # Label masked cells the same way formatting them one by one would.
+    mask = np.ma.getmaskarray(data)
+    if mask.any():
+        strings[mask] = valfmt(np.ma.masked, None)
+
     # Loop over the data and create a `Text` for each "pixel".
     # Change the text's color depending on the data.
     texts = []
     for i in range(data.shape[0]):
         for j in range(data.shape[1]):
-            kw.update(color=textcolors[int(im.norm(data[i, j]) > threshold)])
-            text = im.axes.text(j, i, valfmt(data[i, j], None), **kw)
+            kw.update(color=textcolors[color_idx[i, j]])
+            text = im.axes.text(j, i, strings[i, j], **kw)
             texts.append(text)
 
     return texts
 
 
-def plot_mesh(mesh, title='', subtitle=''):
+def plot_mesh(mesh, title='', subtitle='', max_annotate_cells=400,
+              norm=MESH_NORM):
     fig, ax = plt.subplots(figsize=(8,8))
 
     data = mesh['mesh']
-    # absmax = max(abs(data.min()), abs(data.max()))
-    absmax = 0.2
-    norm = TwoSlopeNorm(vmin=-absmax, vcenter=0, vmax=absmax)
-    im, cbar = heatmap(mesh['mesh'], mesh['x'], mesh['y'], ax=ax,
+    im, cbar = heatmap(mesh['mesh'],
+                       np.round(mesh['x'], decimals=1),
+                       np.round(mesh['y'], decimals=1),
+                       ax=ax,
                        cmap="RdBu_r", norm=norm, cbarlabel="Z-Offset")
-    texts = annotate_heatmap(im, valfmt="{x:.4f}")
-    plt.gca().invert_yaxis()
-    plt.suptitle(title, fontsize=18)
-    plt.title(subtitle, fontsize=10)
-    fig.tight_layout(rect=[0, 0.03, 1, 0.95])
+    # Per-cell labels dominate render time and become unreadable on large
+    # meshes, so only annotate up to max_annotate_cells points.
+    if data.size <= max_annotate_cells:
+        texts = annotate_heatmap(im, valfmt="{x:.4f}")
+    ax.invert_yaxis()
+    fig.suptitle(title, fontsize=18)
+    ax.set_title(subtitle, fontsize=10)
+    fig.subplots_adjust(**MESH_MARGINS)
     return(fig)
 
 
@@ -176,25 +220,44 @@ def calc_mesh_delta(mesh_ref, mesh_test):
     return {'x': mesh_ref['x'], 'y': mesh_ref['y'], 'mesh': delta}
 
 
+def calc_deflections(mesh):
+    # Deflection relative to the highest point along the middle row and
+    # the left and right mesh columns.
+    x_mid = mesh[(mesh.shape[0]-1)//2]
+    y_min = mesh[:, 0]
+    y_max = mesh[:, -1]
+    return (x_mid.max() - x_mid,
+            y_min.max() - y_min,
+            y_max.max() - y_max)
+
+
+def read_results_npz(results_fp):
+    with np.load(results_fp) as archive:
+        results = json.loads(archive['meta'].item())
+        for section in archive.files:
+            if section != 'meta':
+                results[section]['mesh']['probed_matrix'] = archive[section]
+    return(results)
+
+
 def read_results_file(results_fp):
-    with open(results_fp, 'r') as f:
-        results = json.load(f)
+    if splitext(results_fp)[1] == '.npz':
+        return read_results_npz(results_fp)
+    if orjson is not None:
+        with open(results_fp, 'rb') as f:
+            results = orjson.loads(f.read())
+    else:
+        with open(results_fp, 'r') as f:
+            results = json.load(f)
     return(results)
 
 
 def plot_deflections(delta, title=''):
     fig, ax = plt.subplots(2)
 
-    fig.tight_layout(rect=[0, 0.03, 1, 0.85])
-
-    x_mid = delta['mesh'][int(np.floor(delta['mesh'].shape[0]-1)/2)]
-    x_deflect = - x_mid - min(-x_mid)
+    fig.subplots_adjust(**PROFILE_MARGINS)
 
-    y_min = delta['mesh'][:, 0]
-    y_min_deflect = - y_min - min(-y_min)
-
-    y_max = delta['mesh'][:, -1]
-    y_max_deflect = - y_max - min(-y_max)
+    x_deflect, y_min_deflect, y_max_deflect = calc_deflections(delta['mesh'])
 
     ax[0].plot(delta['x'],
                x_deflect,
@@ -202,7 +265,7 @@ def plot_deflections(delta, title=''):
                color="#6d89bf")
 
     ax[0].plot(delta['x'],
-               np.zeros(delta['x'].shape),
+               np.zeros_like(delta['x']),
                '--',
                color="#dddddd")
 
@@ -217,7 +280,7 @@ def plot_deflections(delta, title=''):
                color="#1a376e")
 
     ax[1].plot(delta['y'],
-               np.zeros(delta['y'].shape),
+               np.zeros_like(delta['y']),
                '--',
                color="#dddddd")
 
@@ -227,7 +290,7 @@ def plot_deflections(delta, title=''):
     ax[0].set_ylim([-0.2, 0.2])
     ax[1].set_ylim([-0.2, 0.2])
 
-    plt.suptitle(title, fontsize=12)
+    fig.suptitle(title, fontsize=12)
 
     return(fig)
 
@@ -235,33 +298,39 @@ def plot_deflections(delta, title=''):
 def plot_deflection_surface(delta, title=''):
     fig, ax = plt.subplots(2)
 
-    fig.tight_layout(rect=[0, 0.03, 1, 0.85])
-    for i in reversed(range(delta['mesh'].shape[0])):
-        xgrad = cm.get_cmap('Blues_r',
-                            delta['mesh'].shape[0] + 2)
-        ax[0].plot(delta['x'],
-                   delta['mesh'][i],
-                   '-',
-                   color=xgrad(i),
-                   alpha=1)
-    
-    for i in reversed(range(delta['mesh'].shape[1])):
-        ygrad = cm.get_cmap('Blues_r',
-                            delta['mesh'].shape[1] + 2)
-        ax[1].plot(delta['y'],
-                   delta['mesh'][:,i],
-                   '-',
-                   color=ygrad(i),
-                   alpha=0.8)
-        
+    fig.subplots_adjust(**PROFILE_MARGINS)
+    # Draw each axis as a single LineCollection. Segments are stacked in
+    # reverse so the first row/column ends up on top, as with ax.plot.
+    n_rows, n_cols = delta['mesh'].shape
+
+    xgrad = matplotlib.colormaps['Blues_r'].resampled(n_rows + 2)
+    segs_x = np.stack(np.broadcast_arrays(delta['x'], delta['mesh']),
+                      axis=-1)
+    ax[0].add_collection(LineCollection(segs_x[::-1],
+                                        colors=xgrad(np.arange(n_rows))[::-1],
+                                        linestyle='-',
+                                        alpha=1))
+    ax[0].autoscale_view()
+
+    ygrad = matplotlib.colormaps['Blues_r'].resampled(n_cols + 2)
+    segs_y = np.stack(np.broadcast_arrays(delta['y'], delta['mesh'].T),
+                      axis=-1)
+    ax[1].add_collection(LineCollection(segs_y[::-1],
+                                        colors=ygrad(np.arange(n_cols))[::-1],
+                                        linestyle='-',
+                                        alpha=0.8))
+    ax[1].autoscale_view()
+
+    zeros_x = np.zeros_like(delta['x'])
+    zeros_y = np.zeros_like(delta['y'])
 
     ax[0].plot(delta['x'],
-               np.zeros(delta['x'].shape),
+               zeros_x,
                '--',
                color="#dddddd")
 
     ax[1].plot(delta['y'],
-               np.zeros(delta['y'].shape),
+               zeros_y,
                '--',
                color="#dddddd")
 
@@ -271,67 +340,76 @@ def plot_deflection_surface(delta, title=''):
     ax[0].set_ylim([-0.2, 0.2])
     ax[1].set_ylim([-0.2, 0.2])
 
-    plt.suptitle(title, fontsize=12)
+    fig.suptitle(title, fontsize=12)
     return(fig)
 
 
+def process_one(infile):
+    results = read_results_file(infile)
+
+    user = results['metadata']['user']['id']
+    printer = results['metadata']['user']['printer']
+    backers = results['metadata']['user']['backers']
+    x_rails = results['metadata']['user']['x_rails']
+
+    subtitle = '{user}: {printer}\n{backers}, {x_rails}'.format(user=user,
+                                                                printer=printer,
+                                                                backers=backers,
+                                                                x_rails=x_rails)
+    premesh = True
+    try:
+        mesh_pre = import_mesh(results['pre_mesh']['mesh'])
+    except KeyError:
+        premesh = False
+    mesh_ref = import_mesh(results['cold_mesh']['mesh'])
+    mesh_test = import_mesh(results['hot_mesh']['mesh'])
+    delta = calc_mesh_delta(mesh_ref, mesh_test)
+
+
+    meshplot = plot_mesh(delta,
+                         title='Difference',
+                         subtitle=subtitle)
+    coldplot = plot_mesh(mesh_ref,
+                         title='Cold frame mesh',
+                         subtitle=subtitle)
+    postplot = plot_mesh(mesh_test,
+                         title='Hot frame mesh',
+                         subtitle=subtitle)
+    defplot = plot_deflections(delta,
+                               title=subtitle)
+    surfplot = plot_deflection_surface(delta,
+                                       title=subtitle)
+
+    plot_basename = splitext(infile)[0]
+    meshplot.savefig(f'{plot_basename}.mesh.png', dpi=100)
+    coldplot.savefig(f'{plot_basename}.coldmesh.png', dpi=100)
+    postplot.savefig(f'{plot_basename}.postmesh.png', dpi=100)
+    defplot.savefig(f'{plot_basename}.deflection.png', dpi=100)
+    surfplot.savefig(f'{plot_basename}.surface.png', dpi=100)
+
+    if premesh:
+        preplot = plot_mesh(mesh_pre,
+                            title='Cold bed mesh',
+                            subtitle=subtitle)
+        bed_delta = calc_mesh_delta(mesh_pre, mesh_ref)
+        bedplot = meshplot = plot_mesh(bed_delta,
+                                       title='Bed heatup diff',
+                                       subtitle=subtitle)
+        preplot.savefig(f'{plot_basename}.bed_coldmesh.png', dpi=100)
+        bedplot.savefig(f'{plot_basename}.bed_diffmesh.png', dpi=100)
+
+    plt.close('all')
+
+
 if __name__ == "__main__":
     args = sys.argv[1:]
     print(len(args))
     print(args)
-    for infile in args:
-
-        results = read_results_file(infile)
-
-        user = results['metadata']['user']['id']
-        printer = results['metadata']['user']['printer']
-        backers = results['metadata']['user']['backers']
-        x_rails = results['metadata']['user']['x_rails']
-
-        subtitle = '{user}: {printer}\n{backers}, {x_rails}'.format(user=user,
-                                                                    printer=printer,
-                                                                    backers=backers,
-                                                                    x_rails=x_rails)
-        premesh = True
-        try:
-            mesh_pre = import_mesh(results['pre_mesh']['mesh'])
-        except KeyError:
-            premesh = False
-        mesh_ref = import_mesh(results['cold_mesh']['mesh'])
-        mesh_test = import_mesh(results['hot_mesh']['mesh'])
-        delta = calc_mesh_delta(mesh_ref, mesh_test)
-
-
-        meshplot = plot_mesh(delta,
-                             title='Difference',
-                             subtitle=subtitle)
-        coldplot = plot_mesh(mesh_ref,
-                             title='Cold frame mesh',
-                             subtitle=subtitle)
-        postplot = plot_mesh(mesh_test,
-                             title='Hot frame mesh',
-                             subtitle=subtitle)
-        defplot = plot_deflections(delta,
-                                   title=subtitle)
-        surfplot = plot_deflection_surface(delta,
-                                           title=subtitle)
-
-        plot_basename = splitext(infile)[0]
-        meshplot.savefig('.'.join([plot_basename, 'mesh.png']))
-        coldplot.savefig('.'.join([plot_basename, 'coldmesh.png']))
-        postplot.savefig('.'.join([plot_basename, 'postmesh.png']))
-        defplot.savefig('.'.join([plot_basename, 'deflection.png']))
-        surfplot.savefig('.'.join([plot_basename, 'surface.png']))
-
-        if premesh:
-            preplot = plot_mesh(mesh_pre,
-                                title='Cold bed mesh',
-                                subtitle=subtitle)
-            bed_delta = calc_mesh_delta(mesh_pre, mesh_ref)
-            bedplot = meshplot = plot_mesh(bed_delta,
-                                           title='Bed heatup diff',
-                                           subtitle=subtitle)
-            preplot.savefig('.'.join([plot_basename, 'bed_coldmesh.png']))
-            bedplot.savefig('.'.join([plot_basename, 'bed_diffmesh.png']))
-            
-        plt.close('all')
+    # Each results file is plotted independently, so spread them over
+    # worker processes.
+    if len(args) > 1:
+        with Pool(min(len(args), cpu_count())) as pool:
+            pool.map(process_one, args)
+    else:
+        for infile in args:
+            process_one(infile)